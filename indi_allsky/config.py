@@ -125,6 +125,7 @@ class IndiAllSkyConfigBase(object):
         "STARTRAILS_PIXEL_THOLD": 1.0,
         "STARTRAILS_TIMELAPSE"  : True,
         "STARTRAILS_TIMELAPSE_MINFRAMES" : 250,
+        "STARTRAILS_TIMELAPSE_RAW_CACHE" : False,
         "STARTRAILS_SUN_ALT_THOLD"       : -15.0,
         "STARTRAILS_MOONMODE_THOLD"      : True,
         "STARTRAILS_MOON_ALT_THOLD"      : 91.0,
@@ -1,6 +1,6 @@
 import os
+import io
 import cv2
-from fractions import Fraction
 import math
 import numpy
 from datetime import datetime
@@ -12,12 +12,59 @@ import time
 from pathlib import Path
 import tempfile
 import ephem
+import threading
+import collections
+import concurrent.futures
+import multiprocessing
+import psutil
 import logging
 
+try:
+    # python 3.8+
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+except ImportError:
+    shared_memory = None
+    resource_tracker = None
+
 
 logger = logging.getLogger('indi_allsky')
 
 
+# star trail generator copy used by each worker process
+_worker_stg = None
+
+
+def _processPoolInit(worker_state):
+    global _worker_stg
+
+    # each worker process screens one image at a time
+    cv2.setNumThreads(1)
+
+    _worker_stg = StarTrailGenerator.__new__(StarTrailGenerator)
+    _worker_stg._setWorkerState(worker_state)
+
+
+def _processPoolLoadAndScreen(file_p, image_mtime):
+    result = _worker_stg._loadAndScreen(file_p, image_mtime)
+
+    if isinstance(result, type(None)):
+        return result
+
+
+    file_p, image, image_mtime, m_avg, accept, screen_elapsed_s = result
+
+    # pass the image back through shared memory instead of pickling the data
+    shm = shared_memory.SharedMemory(create=True, size=image.nbytes)
+    shm_image = numpy.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)
+    shm_image[:] = image
+
+    del shm_image
+    shm.close()
+
+    return file_p, (shm.name, image.shape, image.dtype.str), image_mtime, m_avg, accept, screen_elapsed_s
+
+
 
 class StarTrailGenerator(object):
 
@@ -42,6 +89,7 @@ class StarTrailGenerator(object):
 
 
         self.trail_image = None
+        self._image_shape = None  # all images must match the first image
         self.trail_count = 0
         self.pixels_cutoff = None
         self.excluded_images = 0
@@ -50,18 +98,58 @@ class StarTrailGenerator(object):
         self.sun = ephem.Sun()
         self.moon = ephem.Moon()
 
+        # sun/moon positions sampled over the time range of the images
+        self._ephem_grid = None
+        self._ephem_grid_interval = 300  # seconds, interpolation error stays under the margin
+        self._ephem_grid_margin = 1.0  # degrees/percent around the thresholds
+        self._ephem_grid_window = 14400  # seconds sampled ahead when images are processed one at a time
+        self._last_image_mtime = None
+
+        # use worker processes instead of threads to screen images this size or larger
+        self._process_pool_min_pixels = 2000000
+
+        # images may be screened from multiple threads
+        self._init_lock = threading.Lock()
+        self._ephem_lock = threading.Lock()
+
         self.image_processing_elapsed_s = 0
 
+        # make sure the SIMD optimized code paths are enabled
+        cv2.setUseOptimized(True)
+
         self._sqm_mask = self._preprocess_mask(mask)
 
+        # images are downscaled by this factor for brightness screening
+        self._screen_scale = 4
+        self._sqm_mask_small = None
+        self._sqm_roi_slice = None  # set when the mask is a plain rectangle
+
         # this is a default image that is used in case all images are excluded
         self.placeholder_image = None
         self.placeholder_adu = 255
+        self._placeholder_candidates = list()  # images excluded before they were measured
 
 
         self._timelapse_frame_count = 0
         self._timelapse_frame_list = list()
 
+        # timelapse frames are encoded in the background
+        self._writer_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self._writer_futures = collections.deque()
+        self._writer_max_pending = 4
+
+        # cv2.max() is split into row bands for very large images
+        self._max_pool = None
+        self._max_band_count = min(4, psutil.cpu_count() or 1)  # memory bandwidth, not CPU, is the limit
+        self._opencv_threads_pinned = False  # only split when OpenCV is not already using threads
+        self._max_bands_min_pixels = 8000000
+
+        # optionally store timelapse frames uncompressed and encode them later
+        self._raw_cache_enabled = bool(self.config.get('STARTRAILS_TIMELAPSE_RAW_CACHE', False))
+        self._raw_cache = None
+        self._raw_cache_capacity = 0
+        self._raw_cache_mtimes = list()
+
 
         if self.config['IMAGE_FOLDER']:
             self.image_dir = Path(self.config['IMAGE_FOLDER']).absolute()
@@ -71,6 +159,7 @@ class StarTrailGenerator(object):
 
         self.timelapse_tmpdir = tempfile.TemporaryDirectory(dir=self.image_dir, suffix='_startrail_timelapse')
         self.timelapse_tmpdir_p = Path(self.timelapse_tmpdir.name)
+        self._raw_cache_p = self.timelapse_tmpdir_p.joinpath('trails.raw')
 
 
     def __del__(self):
@@ -111,6 +200,7 @@ class StarTrailGenerator(object):
 
     @property
     def timelapse_frame_list(self):
+        # cached raw frames are only included after encodeTimelapseFrames()
         return self._timelapse_frame_list
 
     @timelapse_frame_list.setter
@@ -177,167 +267,773 @@ class StarTrailGenerator(object):
 
 
 
-    def generate(self, outfile, file_list):
+    def generate(self, outfile, file_list, camera, image_callback=None):
+        # image_callback(file_p, image) is called with every decoded image in
+        # timestamp order, allowing the keogram to share the decoded images
+        # stat() each file only once
+        file_stat_list = [(p, p.stat()) for p in file_list]
+
         # Exclude empty files
-        file_list_nonzero = filter(lambda p: p.stat().st_size != 0, file_list)
+        file_stat_nonzero = filter(lambda x: x[1].st_size != 0, file_stat_list)
 
         # Sort by timestamp
-        file_list_ordered = sorted(file_list_nonzero, key=lambda p: p.stat().st_mtime)
+        file_stat_ordered = sorted(file_stat_nonzero, key=lambda x: x[1].st_mtime)
 
 
         processing_start = time.time()
 
-        for file_p in file_list_ordered:
-            logger.info('Reading file: %s', file_p)
 
+        if file_stat_ordered:
+            self._generateEphemGrid(file_stat_ordered[0][1].st_mtime, file_stat_ordered[-1][1].st_mtime, len(file_stat_ordered))
+
+
+        # The first readable image sets the star trail dimensions and the masks
+        # before the pool starts, so every worker checks against the same shape
+        file_stat_queue = collections.deque(file_stat_ordered)
+        first_result = None
+        while file_stat_queue and isinstance(self._image_shape, type(None)):
+            file_p, file_st = file_stat_queue.popleft()
+            first_result = self._loadAndScreen(file_p, file_st.st_mtime)
+
+
+        # Decoding and screening images is independent for each file and is
+        # done in a thread or process pool.  The images must be combined in order
+        # to keep the timelapse frames consistent, so futures are consumed in the
+        # order they were submitted.
+        worker_count = psutil.cpu_count() or 1
+        pending_futures = collections.deque()
+        image_total = len(file_stat_ordered)
+
+        if self._useProcessPool():
+            logger.info('Screening images with %d processes', worker_count)
+
+            # worker processes must share the resource tracker for the shared memory segments
+            resource_tracker.ensure_running()
+
+            executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=worker_count,
+                initializer=_processPoolInit,
+                initargs=(self._getWorkerState(),),
+            )
+            load_func = _processPoolLoadAndScreen
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=worker_count)
+            load_func = self._loadAndScreen
+
+
+        # The pool already runs one image per CPU, OpenCV's own threads would
+        # only oversubscribe the CPUs.  The setting is global for the process,
+        # so the previous value is restored afterwards.
+        opencv_threads = cv2.getNumThreads()
+        cv2.setNumThreads(1)
+        self._opencv_threads_pinned = True
+
+
+        try:
+            with executor:
+                try:
+                    self._reduceResult(first_result, image_callback)
+
+                    for i, (file_p, file_st) in enumerate(file_stat_queue, start=image_total - len(file_stat_queue)):
+                        if i % 100 == 0:
+                            logger.info('Processed %d of %d images', i, image_total)
+
+                        pending_futures.append(executor.submit(load_func, file_p, file_st.st_mtime))
+
+                        # limit the number of decoded images held in memory
+                        if len(pending_futures) >= worker_count * 2:
+                            self._reduceResult(pending_futures.popleft().result(), image_callback)
+
+
+                    while pending_futures:
+                        self._reduceResult(pending_futures.popleft().result(), image_callback)
+                finally:
+                    # only left over if processing failed
+                    for future in pending_futures:
+                        future.cancel()
+
+                    while pending_futures:
+                        self._discardResult(pending_futures.popleft())
+        finally:
+            self._opencv_threads_pinned = False
+            cv2.setNumThreads(opencv_threads)
+
+
+        self.finalize(outfile, camera)
+
+
+        processing_elapsed_s = time.time() - processing_start
+        logger.warning('Total star trail processing in %0.1f s', processing_elapsed_s)
+
+
+    def _useProcessPool(self):
+        if not shared_memory:
+            return False
+
+        if multiprocessing.current_process().daemon:
+            # daemon processes cannot have children
+            return False
+
+        if isinstance(self._image_shape, type(None)):
+            # no readable images
+            return False
+
+
+        image_height, image_width = self._image_shape[:2]
+
+        # copying small images between processes costs more than it saves
+        return (image_width * image_height) >= self._process_pool_min_pixels
+
+
+    def _getWorkerState(self):
+        # Worker processes only need the settings used for screening
+
+        exclude_keys = (
+            'obs',
+            'sun',
+            'moon',
+            '_init_lock',
+            '_ephem_lock',
+            'trail_image',
+            'placeholder_image',
+            '_placeholder_candidates',
+            '_timelapse_frame_list',
+            '_writer_pool',
+            '_writer_futures',
+            '_max_pool',
+            '_raw_cache',
+            'timelapse_tmpdir',
+        )
+
+        return {k: v for k, v in self.__dict__.items() if k not in exclude_keys}
+
+
+    def _setWorkerState(self, worker_state):
+        self.__dict__.update(worker_state)
+
+        self.obs = ephem.Observer()
+        self.obs.lat = math.radians(self._latitude)
+        self.obs.lon = math.radians(self._longitude)
+        self.sun = ephem.Sun()
+        self.moon = ephem.Moon()
+
+        self._init_lock = threading.Lock()
+        self._ephem_lock = threading.Lock()
+
+        self.trail_image = None
+        self.placeholder_image = None
+        self._placeholder_candidates = list()
+
+        # workers do not write timelapse frames or own the temp folder
+        self._timelapse_frame_list = list()
+        self._writer_pool = None
+        self._max_pool = None
+        self._writer_futures = collections.deque()
+        self._raw_cache = None
+        self.timelapse_tmpdir = None
+
+
+    def _loadAndScreen(self, file_p, image_mtime):
+        image = self._readImage(file_p)
+
+        if isinstance(image, type(None)):
+            return None
+
+
+        self._initImage(image)
+
+        if image.shape != self._image_shape:
+            logger.error('Image %s does not match star trail dimensions: %s', file_p, str(image.shape))
+            return None
+
+
+        screen_start = time.time()
+
+        m_avg, accept = self._screenImage(image, image_mtime)
+
+        screen_elapsed_s = time.time() - screen_start
+
+        return file_p, image, image_mtime, m_avg, accept, screen_elapsed_s
+
+
+    def _readImage(self, file_p):
+        logger.info('Reading file: %s', file_p)
+
+        # opencv decodes directly to BGR
+        image = cv2.imread(str(file_p), cv2.IMREAD_COLOR)
+
+        if isinstance(image, type(None)):
+            # fallback to Pillow for formats opencv cannot read
             try:
                 with Image.open(str(file_p)) as img:
-                    image = cv2.cvtColor(numpy.array(img), cv2.COLOR_RGB2BGR)
+                    # alpha, palette, and mono images are converted to 3 channel 8-bit RGB
+                    image = cv2.cvtColor(numpy.asarray(img.convert('RGB')), cv2.COLOR_RGB2BGR)
             except PIL.UnidentifiedImageError:
                 logger.error('Unable to read %s', file_p)
-                continue
+                return None
 
 
-            self.processImage(file_p, image)
+        # opencv only uses the SIMD code paths with contiguous data of the same type
+        return numpy.ascontiguousarray(image, dtype=numpy.uint8)
 
 
-        self.finalize(outfile)
+    def _reduceResult(self, result, image_callback=None):
+        if isinstance(result, type(None)):
+            # image could not be read
+            return
 
+        file_p, image, image_mtime, m_avg, accept, screen_elapsed_s = result
 
-        processing_elapsed_s = time.time() - processing_start
-        logger.warning('Total star trail processing in %0.1f s', processing_elapsed_s)
+        if isinstance(image, tuple):
+            # image was returned from a worker process in shared memory
+            shm_name, image_shape, image_dtype = image
+
+            shm = shared_memory.SharedMemory(name=shm_name)
+
+            try:
+                image = numpy.ndarray(image_shape, dtype=image_dtype, buffer=shm.buf)
+
+                reduce_elapsed_s = self._reduceLoadedImage(file_p, image, image_mtime, m_avg, accept, image_callback)
+
+                if self.placeholder_image is image:
+                    # the shared memory is released below
+                    self.placeholder_image = image.copy()
+
+                del image
+            finally:
+                shm.close()
+                shm.unlink()
+        else:
+            reduce_elapsed_s = self._reduceLoadedImage(file_p, image, image_mtime, m_avg, accept, image_callback)
+
+        self.image_processing_elapsed_s += screen_elapsed_s + reduce_elapsed_s
+
+
+    def _reduceLoadedImage(self, file_p, image, image_mtime, m_avg, accept, image_callback):
+        # Returns the time spent combining the image, the callback is not included
+
+        if image.shape != self.trail_image.shape:
+            logger.error('Image %s does not match star trail dimensions: %s', file_p, str(image.shape))
+            return 0.0
+
+
+        if image_callback:
+            image_callback(file_p, image)
+
+        reduce_start = time.time()
+
+        self._reduceImage(file_p, image, image_mtime, m_avg, accept)
+
+        return time.time() - reduce_start
+
+
+    def _discardResult(self, future):
+        # release the shared memory of an image that will not be combined
+        if future.cancelled():
+            return
+
+        try:
+            result = future.result()
+        except Exception:
+            return
+
+        if isinstance(result, type(None)):
+            return
+
+        image = result[1]
+
+        if isinstance(image, tuple):
+            shm = shared_memory.SharedMemory(name=image[0])
+            shm.close()
+            shm.unlink()
 
 
-    def processImage(self, file_p, image):
+    def processImage(self, file_p, image, image_mtime=None):
         image_processing_start = time.time()
 
+        if isinstance(image_mtime, type(None)):
+            image_mtime = file_p.stat().st_mtime
 
-        if isinstance(self.trail_image, type(None)):
-            image_height, image_width = image.shape[:2]
+        if not self._ephemGridCovers(image_mtime) and not isinstance(self._last_image_mtime, type(None)):
+            # the time range of the images is not known in advance, the grid
+            # only helps when images are closer together than the grid interval
+            if abs(image_mtime - self._last_image_mtime) < self._ephem_grid_interval:
+                self._generateEphemGrid(image_mtime, image_mtime + self._ephem_grid_window)
 
-            self.pixels_cutoff = (image_height * image_width) * (self._pixel_cutoff_threshold / 100)
+        self._last_image_mtime = image_mtime
 
-            # base image is just a black image
-            if len(image.shape) == 2:
-                self.trail_image = numpy.zeros((image_height, image_width), dtype=numpy.uint8)
-            else:
-                self.trail_image = numpy.zeros((image_height, image_width, 3), dtype=numpy.uint8)
+        m_avg, accept = self._screenImage(image, image_mtime)
+        self._reduceImage(file_p, image, image_mtime, m_avg, accept)
 
+        self.image_processing_elapsed_s += time.time() - image_processing_start
 
-        if isinstance(self._sqm_mask, type(None)):
-            self._generateSqmMask(image)
 
+    def _initImage(self, image):
+        with self._init_lock:
+            if isinstance(self._image_shape, type(None)):
+                # worker processes receive the shape from the main process and never allocate a trail image
+                self._image_shape = image.shape
 
+                image_height, image_width = image.shape[:2]
 
-        # need grayscale image for mask generation
-        if len(image.shape) == 2:
-            image_gray = image.copy()
-        else:
-            image_gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                self.pixels_cutoff = (image_height * image_width) * (self._pixel_cutoff_threshold / 100)
 
+                # base image is just a black image
+                if len(image.shape) == 2:
+                    self.trail_image = numpy.zeros((image_height, image_width), dtype=numpy.uint8)
+                else:
+                    self.trail_image = numpy.zeros((image_height, image_width, 3), dtype=numpy.uint8)
 
-        m_avg = cv2.mean(image_gray, mask=self._sqm_mask)[0]
 
+            if isinstance(self._sqm_mask, type(None)):
+                self._generateSqmMask(image)
 
-        if m_avg < self.placeholder_adu:
-            # placeholder should be the image with the lowest calculated ADU
-            self.placeholder_image = image
-            self.placeholder_adu = m_avg
 
+            if isinstance(self._sqm_mask_small, type(None)):
+                image_height, image_width = image.shape[:2]
 
-        mtime_datetime_utc = datetime.fromtimestamp(file_p.stat().st_mtime).astimezone(tz=timezone.utc)
-        self.obs.date = mtime_datetime_utc
+                small_width = max(1, image_width // self._screen_scale)
+                small_height = max(1, image_height // self._screen_scale)
 
-        self.sun.compute(self.obs)
-        sun_alt = math.degrees(self.sun.alt)
+                # nearest neighbor keeps the mask binary
+                self._sqm_mask_small = cv2.resize(self._sqm_mask, (small_width, small_height), interpolation=cv2.INTER_NEAREST)
 
-        if sun_alt > self.sun_alt_threshold:
-            #logger.warning(' Excluding image due to sun altitude: %0.1f', sun_alt)
-            self.excluded_images += 1
-            return
+                self._sqm_roi_slice = self._sqmMaskRoi(self._sqm_mask_small)
 
 
-        self.moon.compute(self.obs)
-        moon_alt = math.degrees(self.moon.alt)
-        moon_phase = self.moon.moon_phase * 100.0
+    def _screenImage(self, image, image_mtime):
+        # Returns the image ADU and whether the image should be added to the star trail
+        # The ADU is None if the image was excluded before the pixels were measured
+        # This must not modify any shared state except for the initial setup
+
+        self._initImage(image)
+
+
+        # time based filters are checked first, they do not need to read the image
+        sun_alt, moon_alt, moon_phase = self._sunMoonPosition(image_mtime)
+
+        if sun_alt > self.sun_alt_threshold:
+            #logger.warning(' Excluding image due to sun altitude: %0.1f', sun_alt)
+            return None, False
 
 
         if moon_alt > self.moonmode_alt and moon_phase > self.moonmode_phase:
             #logger.warning(' Excluding image due to moon mode: %0.1f/%0.1f%%', moon_alt, moon_phase)
-            self.excluded_images += 1
-            return
+            return None, False
 
         if moon_alt > self.moon_alt_threshold and moon_phase > self.moon_phase_threshold:
             #logger.warning(' Excluding image due to moon altitude/phase: %0.1f/%0.1f%%', moon_alt, moon_phase)
-            self.excluded_images += 1
-            return
+            return None, False
+
+
+        m_avg, pixels_above_cutoff = self._measureImage(image)
 
 
         if m_avg > self._max_brightness:
             #logger.warning(' Excluding image due to brightness: %0.2f', m_avg)
-            self.excluded_images += 1
-            return
+            return m_avg, False
 
         #logger.info(' Image brightness: %0.2f', m_avg)
 
-        pixels_above_cutoff = (image_gray > self._mask_threshold).sum()
         if pixels_above_cutoff > self.pixels_cutoff:
             #logger.warning(' Excluding image due to pixel cutoff: %d', pixels_above_cutoff)
+            return m_avg, False
+
+
+        return m_avg, True
+
+
+    def _sunMoonPosition(self, image_mtime):
+        # Returns sun altitude, moon altitude, and moon phase
+
+        if self._ephemGridCovers(image_mtime):
+            grid_ts, grid_sun_alt, grid_moon_alt, grid_moon_phase = self._ephem_grid
+
+            sun_alt = float(numpy.interp(image_mtime, grid_ts, grid_sun_alt))
+            moon_alt = float(numpy.interp(image_mtime, grid_ts, grid_moon_alt))
+            moon_phase = float(numpy.interp(image_mtime, grid_ts, grid_moon_phase))
+
+
+            # use the exact values when close to any threshold
+            margin = self._ephem_grid_margin
+            near_threshold = abs(sun_alt - self.sun_alt_threshold) <= margin \
+                or abs(moon_alt - self.moonmode_alt) <= margin \
+                or abs(moon_alt - self.moon_alt_threshold) <= margin \
+                or abs(moon_phase - self.moonmode_phase) <= margin \
+                or abs(moon_phase - self.moon_phase_threshold) <= margin
+
+            if not near_threshold:
+                return sun_alt, moon_alt, moon_phase
+
+
+        return self._computeSunMoon(image_mtime)
+
+
+    def _computeSunMoon(self, timestamp):
+        mtime_datetime_utc = datetime.fromtimestamp(timestamp).astimezone(tz=timezone.utc)
+
+        with self._ephem_lock:
+            self.obs.date = mtime_datetime_utc
+
+            self.sun.compute(self.obs)
+            sun_alt = math.degrees(self.sun.alt)
+
+            self.moon.compute(self.obs)
+            moon_alt = math.degrees(self.moon.alt)
+            moon_phase = self.moon.moon_phase * 100.0
+
+        return sun_alt, moon_alt, moon_phase
+
+
+    def _ephemGridCovers(self, image_mtime):
+        if isinstance(self._ephem_grid, type(None)):
+            return False
+
+        grid_ts = self._ephem_grid[0]
+
+        return grid_ts[0] <= image_mtime <= grid_ts[-1]
+
+
+    def _generateEphemGrid(self, start_ts, end_ts, image_count=None):
+        # The sun and moon positions change slowly, sample them at a fixed interval
+        # and interpolate instead of computing the positions for every image
+        grid_ts = numpy.arange(start_ts, end_ts + self._ephem_grid_interval, self._ephem_grid_interval, dtype=numpy.float64)
+
+        if not isinstance(image_count, type(None)) and len(grid_ts) >= image_count:
+            # no benefit over computing each image
+            return
+
+        grid_sun_alt = numpy.zeros(grid_ts.shape, dtype=numpy.float64)
+        grid_moon_alt = numpy.zeros(grid_ts.shape, dtype=numpy.float64)
+        grid_moon_phase = numpy.zeros(grid_ts.shape, dtype=numpy.float64)
+
+        for i, ts in enumerate(grid_ts):
+            grid_sun_alt[i], grid_moon_alt[i], grid_moon_phase[i] = self._computeSunMoon(float(ts))
+
+        logger.info('Computed %d sun/moon positions', len(grid_ts))
+
+        self._ephem_grid = (grid_ts, grid_sun_alt, grid_moon_alt, grid_moon_phase)
+
+
+    def _measureImage(self, image):
+        # Returns the masked ADU and the number of pixels above the mask threshold
+        # Screening is done on downscaled images.  The area average preserves the
+        # mean, but it also dims small bright features, so the pixel cutoff is
+        # counted on a nearest neighbor sample which keeps the original values.
+
+        image_height, image_width = image.shape[:2]
+        small_height, small_width = self._sqm_mask_small.shape[:2]
+
+        small_image = cv2.resize(image, (small_width, small_height), interpolation=cv2.INTER_AREA)
+        sample_image = cv2.resize(image, (small_width, small_height), interpolation=cv2.INTER_NEAREST)
+
+        cutoff_scale = (image_height * image_width) / (small_height * small_width)
+
+
+        if len(small_image.shape) == 2:
+            image_gray = small_image
+            sample_gray = sample_image
+        else:
+            image_gray = cv2.cvtColor(small_image, cv2.COLOR_BGR2GRAY)
+            sample_gray = cv2.cvtColor(sample_image, cv2.COLOR_BGR2GRAY)
+
+
+        if isinstance(self._sqm_roi_slice, type(None)):
+            m_avg = cv2.mean(image_gray, mask=self._sqm_mask_small)[0]
+        else:
+            # a plain rectangle does not need a per pixel mask test
+            m_avg = cv2.mean(image_gray[self._sqm_roi_slice])[0]
+
+        # single pass without a temporary boolean array
+        pixels_above_cutoff = cv2.countNonZero(cv2.compare(sample_gray, float(self._mask_threshold), cv2.CMP_GT))
+
+        return m_avg, pixels_above_cutoff * cutoff_scale
+
+
+    def _sqmMaskRoi(self, mask):
+        # Returns slices for the bounding box of the mask if the mask is a filled rectangle
+
+        x, y, w, h = cv2.boundingRect(mask)
+
+        if w == 0 or h == 0:
+            return None
+
+
+        if cv2.countNonZero(mask[y:y + h, x:x + w]) != w * h:
+            # not a solid rectangle
+            return None
+
+
+        return (slice(y, y + h), slice(x, x + w))
+
+
+    def _reduceImage(self, file_p, image, image_mtime, m_avg, accept):
+        # Combines screened images into the star trail, must be called in order
+
+        if isinstance(m_avg, type(None)):
+            if self.trail_count == 0:
+                # the placeholder is only used if no images are accepted, these
+                # images are measured in finalize if that happens
+                self._placeholder_candidates.append(file_p)
+        elif m_avg < self.placeholder_adu:
+            # placeholder should be the image with the lowest calculated ADU
+            self.placeholder_image = image
+            self.placeholder_adu = m_avg
+
+
+        if not accept:
             self.excluded_images += 1
             return
 
+
         self.trail_count += 1
+        self._placeholder_candidates = list()
 
 
         ### Here is the magic
-        self.trail_image = cv2.max(self.trail_image, image)
+        # a dark image may still contain stars, only a completely black image can be skipped
+        if m_avg >= 1.0 or cv2.countNonZero(image.reshape(image.shape[0], -1)) > 0:
+            self._maxImage(image)
 
 
         # Star trail timelapse processing
-        if self.config.get('STARTRAILS_TIMELAPSE', True):
-            image_mtime = file_p.stat().st_mtime
-
-            f_tmp_frame = tempfile.NamedTemporaryFile(dir=self.timelapse_tmpdir_p, suffix='.{0:s}'.format(self.config['IMAGE_FILE_TYPE']), delete=False)
-            f_tmp_frame.close()
-
-            f_tmp_frame_p = Path(f_tmp_frame.name)
-
-            if self.config['IMAGE_FILE_TYPE'] in ('jpg', 'jpeg'):
-                img_rgb = Image.fromarray(cv2.cvtColor(self.trail_image, cv2.COLOR_BGR2RGB))
-                img_rgb.save(str(f_tmp_frame_p), quality=self.config['IMAGE_FILE_COMPRESSION']['jpg'])
-            elif self.config['IMAGE_FILE_TYPE'] in ('png',):
-                #img_rgb = Image.fromarray(cv2.cvtColor(self.trail_image, cv2.COLOR_BGR2RGB))
-                #img_rgb.save(str(f_tmp_frame_p), compress_level=self.config['IMAGE_FILE_COMPRESSION']['png'])
-
-                # opencv is faster than Pillow with PNG
-                cv2.imwrite(str(f_tmp_frame_p), self.trail_image, [cv2.IMWRITE_PNG_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['png']])
-            elif self.config['IMAGE_FILE_TYPE'] in ('webp',):
-                img_rgb = Image.fromarray(cv2.cvtColor(self.trail_image, cv2.COLOR_BGR2RGB))
-                img_rgb.save(str(f_tmp_frame_p), quality=90, lossless=False)
-            elif self.config['IMAGE_FILE_TYPE'] in ('tif', 'tiff'):
-                img_rgb = Image.fromarray(cv2.cvtColor(self.trail_image, cv2.COLOR_BGR2RGB))
-                img_rgb.save(str(f_tmp_frame_p), compression='tiff_lzw')
+        if self.config.get('STARTRAILS_TIMELAPSE', True) and self._raw_cache_enabled:
+            if self._cacheRawFrame(image_mtime):
+                self._timelapse_frame_count += 1
             else:
-                raise Exception('Unknown file type: %s', self.config['IMAGE_FILE_TYPE'])
+                # the cache could not grow, frames are encoded as they are added from now on
+                self._writeTimelapseFrame(image_mtime)
+        elif self.config.get('STARTRAILS_TIMELAPSE', True):
+            self._writeTimelapseFrame(image_mtime)
 
-            # put original mtime on file
-            os.utime(f_tmp_frame_p, times=(image_mtime, image_mtime))
 
-            self._timelapse_frame_list.append(f_tmp_frame_p)
-            self._timelapse_frame_count += 1
+    def _writeTimelapseFrame(self, image_mtime):
+        # the frame counter keeps the names unique within the temp folder
+        f_tmp_frame_p = self.timelapse_tmpdir_p.joinpath('frame_{0:08d}.{1:s}'.format(self._timelapse_frame_count, self.config['IMAGE_FILE_TYPE']))
 
+        # the trail image is updated in place, the writer needs a snapshot
+        trail_snapshot = self.trail_image.copy()
 
-        self.image_processing_elapsed_s += time.time() - image_processing_start
+        self._writer_futures.append(self._writer_pool.submit(self._encodeFrame, trail_snapshot, f_tmp_frame_p, image_mtime))
+
+        # limit the number of frames waiting to be written
+        while len(self._writer_futures) > self._writer_max_pending:
+            self._writer_futures.popleft().result()
+
+        self._timelapse_frame_list.append(f_tmp_frame_p)
+        self._timelapse_frame_count += 1
+
+
+    def _measurePlaceholderCandidates(self):
+        # Images excluded by the sun/moon filters were never measured, one of
+        # them may be darker than the current placeholder
+        if not self._placeholder_candidates:
+            return
+
+        logger.info('Measuring %d images for the placeholder image', len(self._placeholder_candidates))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=psutil.cpu_count() or 1) as executor:
+            m_avg_list = list(executor.map(self._measureFile, self._placeholder_candidates))
+
+
+        placeholder_p = None
+        for file_p, m_avg in zip(self._placeholder_candidates, m_avg_list):
+            if isinstance(m_avg, type(None)):
+                continue
+
+            if m_avg < self.placeholder_adu:
+                placeholder_p = file_p
+                self.placeholder_adu = m_avg
+
+
+        # only the darkest image is kept in memory
+        if not isinstance(placeholder_p, type(None)):
+            self.placeholder_image = self._readImage(placeholder_p)
+
+        self._placeholder_candidates = list()
+
+
+    def _measureFile(self, file_p):
+        image = self._readImage(file_p)
+
+        if isinstance(image, type(None)):
+            return None
+
+        if image.shape != self._image_shape:
+            return None
+
+        return self._measureImage(image)[0]
+
+
+    def _maxImage(self, image):
+        image_height, image_width = image.shape[:2]
+
+        if (image_height * image_width) < self._max_bands_min_pixels or self._max_band_count < 2 or not self._opencv_threads_pinned:
+            # update in place to avoid allocating a new image for every frame
+            cv2.max(self.trail_image, image, dst=self.trail_image)
+            return
+
+
+        if isinstance(self._max_pool, type(None)):
+            self._max_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_band_count)
+
+
+        band_bounds = numpy.linspace(0, image_height, self._max_band_count + 1, dtype=numpy.int64)
+
+        futures = [
+            self._max_pool.submit(self._maxBand, image, int(y1), int(y2))
+            for y1, y2 in zip(band_bounds[:-1], band_bounds[1:])
+        ]
+
+        for future in futures:
+            future.result()
+
+
+    def _maxBand(self, image, y1, y2):
+        # row slices are contiguous, the band is updated in place
+        trail_band = self.trail_image[y1:y2]
+        cv2.max(trail_band, image[y1:y2], dst=trail_band)
+
+
+    def _cacheRawFrame(self, image_mtime):
+        # Copies the trail image into a memory mapped file, no encoding is done
+        # Returns False if the cache could not grow and has been disabled
+        if self._timelapse_frame_count >= self._raw_cache_capacity:
+            try:
+                self._growRawCache()
+            except (OSError, ValueError, OverflowError) as e:
+                # 32-bit systems run out of address space after a few GB
+                logger.error('Unable to grow star trail timelapse frame cache to %d frames: %s', max(64, self._raw_cache_capacity * 2), str(e))
+                self._disableRawCache()
+                return False
+
+        self._raw_cache[self._timelapse_frame_count] = self.trail_image
+        self._raw_cache_mtimes.append(image_mtime)
+
+        return True
+
+
+    def _growRawCache(self):
+        new_capacity = max(64, self._raw_cache_capacity * 2)
+
+        if not isinstance(self._raw_cache, type(None)):
+            self._raw_cache.flush()
+
+
+        # extending the file does not write the new space
+        with io.open(str(self._raw_cache_p), 'ab') as f_raw:
+            f_raw.truncate(new_capacity * self.trail_image.nbytes)
+
+
+        # the previous mapping is kept until the new mapping succeeds
+        self._raw_cache = numpy.memmap(
+            str(self._raw_cache_p),
+            dtype=numpy.uint8,
+            mode='r+',
+            shape=(new_capacity,) + self.trail_image.shape,
+        )
+
+        self._raw_cache_capacity = new_capacity
+
+
+    def _disableRawCache(self):
+        # Encodes the frames cached so far, later frames use the writer pool
+        logger.warning('Encoding %d cached star trail timelapse frames', self._timelapse_frame_count - len(self._timelapse_frame_list))
+
+        self._encodeRawCache()
+
+        self._raw_cache_enabled = False
+        self._raw_cache = None
+        self._raw_cache_capacity = 0
+        self._raw_cache_mtimes = list()
+
+        try:
+            self._raw_cache_p.unlink()
+        except FileNotFoundError:
+            pass
+
+
+    def encodeTimelapseFrames(self):
+        # Writes any frames held in the raw cache, call before using timelapse_frame_list
+        if self._raw_cache_enabled:
+            self._encodeRawCache()
+
+
+    def _encodeRawCache(self):
+        # Encodes the cached frames that have not been written yet
+        start_frame = len(self._timelapse_frame_list)
+
+        if start_frame >= self._timelapse_frame_count:
+            return
+
+
+        encode_start = time.time()
+
+        frame_list = list()
+        for i in range(start_frame, self._timelapse_frame_count):
+            f_tmp_frame_p = self.timelapse_tmpdir_p.joinpath('frame_{0:08d}.{1:s}'.format(i, self.config['IMAGE_FILE_TYPE']))
+            frame_list.append(f_tmp_frame_p)
+
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=psutil.cpu_count() or 1) as executor:
+            futures = [
+                executor.submit(self._encodeFrame, self._raw_cache[i], f_tmp_frame_p, self._raw_cache_mtimes[i])
+                for i, f_tmp_frame_p in enumerate(frame_list, start=start_frame)
+            ]
+
+            for future in futures:
+                future.result()
+
+
+        self._timelapse_frame_list.extend(frame_list)
+
+        encode_elapsed_s = time.time() - encode_start
+        logger.info('Encoded %d star trail timelapse frames in %0.1f s', len(frame_list), encode_elapsed_s)
+
+
+    def _encodeFrame(self, image, f_tmp_frame_p, image_mtime):
+        # EXIF data is not needed for timelapse frames, opencv is faster than Pillow
+        if self.config['IMAGE_FILE_TYPE'] in ('jpg', 'jpeg'):
+            cv2.imwrite(str(f_tmp_frame_p), image, [cv2.IMWRITE_JPEG_QUALITY, self.config['IMAGE_FILE_COMPRESSION']['jpg']])
+        elif self.config['IMAGE_FILE_TYPE'] in ('png',):
+            #img_rgb = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+            #img_rgb.save(str(f_tmp_frame_p), compress_level=self.config['IMAGE_FILE_COMPRESSION']['png'])
+
+            # opencv is faster than Pillow with PNG
+            cv2.imwrite(str(f_tmp_frame_p), image, [cv2.IMWRITE_PNG_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['png']])
+        elif self.config['IMAGE_FILE_TYPE'] in ('webp',):
+            cv2.imwrite(str(f_tmp_frame_p), image, [cv2.IMWRITE_WEBP_QUALITY, 90])
+        elif self.config['IMAGE_FILE_TYPE'] in ('tif', 'tiff'):
+            # opencv writes the BGR image directly, no color conversion needed
+            cv2.imwrite(str(f_tmp_frame_p), image, [cv2.IMWRITE_TIFF_COMPRESSION, 5])  # LZW
+        else:
+            raise Exception('Unknown file type: %s', self.config['IMAGE_FILE_TYPE'])
+
+        # put original mtime on file
+        os.utime(f_tmp_frame_p, times=(image_mtime, image_mtime))
 
 
     def finalize(self, outfile, camera):
         outfile_p = Path(outfile)
 
+        # wait for all timelapse frames to be written
+        while self._writer_futures:
+            self._writer_futures.popleft().result()
+
+        self._writer_pool.shutdown(wait=True)
+
+        if not isinstance(self._max_pool, type(None)):
+            self._max_pool.shutdown(wait=True)
+            self._max_pool = None
+
+
         logger.warning('Star trails images processed in %0.1f s', self.image_processing_elapsed_s)
         logger.warning('Excluded %d images', self.excluded_images)
 
 
         if self.trail_count == 0:
+            self._measurePlaceholderCandidates()
+
             logger.warning('Not enough images found to build star trail, using placeholder image')
             self.trail_image = self.placeholder_image
 
@@ -345,12 +1041,9 @@ class StarTrailGenerator(object):
         ### EXIF tags ###
         exp_date_utc = datetime.utcnow()
 
-        # Python 3.6, 3.7 does not support as_integer_ratio()
-        focal_length_frac = Fraction(camera.lensFocalLength).limit_denominator()
-        focal_length = (focal_length_frac.numerator, focal_length_frac.denominator)
-
-        f_number_frac = Fraction(camera.lensFocalRatio).limit_denominator()
-        f_number = (f_number_frac.numerator, f_number_frac.denominator)
+        # EXIF rationals with 2 decimal places are sufficient for focal length and ratio
+        focal_length = (int(round(camera.lensFocalLength * 100)), 100)
+        f_number = (int(round(camera.lensFocalRatio * 100)), 100)
 
         zeroth_ifd = {
             piexif.ImageIFD.Model            : camera.name,
@@ -422,8 +1115,8 @@ class StarTrailGenerator(object):
             img_rgb = Image.fromarray(cv2.cvtColor(self.trail_image, cv2.COLOR_BGR2RGB))
             img_rgb.save(str(outfile_p), quality=90, lossless=False, exif=jpeg_exif)
         elif self.config['IMAGE_FILE_TYPE'] in ('tif', 'tiff'):
-            img_rgb = Image.fromarray(cv2.cvtColor(self.trail_image, cv2.COLOR_BGR2RGB))
-            img_rgb.save(str(outfile_p), compression='tiff_lzw')
+            # opencv writes the BGR image directly, no color conversion needed
+            cv2.imwrite(str(outfile_p), self.trail_image, [cv2.IMWRITE_TIFF_COMPRESSION, 5])  # LZW
         else:
             raise Exception('Unknown file type: %s', self.config['IMAGE_FILE_TYPE'])
 
@@ -445,6 +1138,18 @@ class StarTrailGenerator(object):
 
 
     def cleanup(self):
+        if isinstance(self.timelapse_tmpdir, type(None)):
+            # worker process copy
+            return
+
+        self._writer_pool.shutdown(wait=True)
+
+        if not isinstance(self._max_pool, type(None)):
+            self._max_pool.shutdown(wait=True)
+
+        # release the memory map before the file is removed
+        self._raw_cache = None
+
         # cleanup the folder
         self.timelapse_tmpdir.cleanup()
 
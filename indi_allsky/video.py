@@ -512,50 +512,56 @@ class VideoWorker(Process):
 
 
         # Files are presorted from the DB
-        for i, entry in enumerate(files_entries):
-            if i % 100 == 0:
-                logger.info('Processed %d of %d images', i, image_count)
-
+        file_list = list()
+        for entry in files_entries:
             p_entry = Path(entry.getFilesystemPath())
 
             if not p_entry.exists():
                 logger.error('File not found: %s', p_entry)
                 continue
 
-            if p_entry.stat().st_size == 0:
-                continue
+            file_list.append(p_entry)
 
 
-            #logger.info('Reading file: %s', p_entry)
-            if p_entry.suffix in ('.png',):
-                # opencv is faster than Pillow with PNG
-                image = cv2.imread(str(p_entry), cv2.IMREAD_COLOR)
+        if night:
+            # star trail images are decoded and screened in parallel, the
+            # keogram receives each decoded image in order
+            stg.generate(startrail_file, file_list, camera, image_callback=kg.processImage)
+        else:
+            for i, p_entry in enumerate(file_list):
+                if i % 100 == 0:
+                    logger.info('Processed %d of %d images', i, image_count)
 
-                if isinstance(image, type(None)):
-                    logger.error('Unable to read %s', p_entry)
-                    continue
-            else:
-                try:
-                    with Image.open(str(p_entry)) as img:
-                        image = cv2.cvtColor(numpy.array(img), cv2.COLOR_RGB2BGR)
-                except PIL.UnidentifiedImageError:
-                    logger.error('Unable to read %s', p_entry)
+                if p_entry.stat().st_size == 0:
                     continue
 
 
-            kg.processImage(p_entry, image)
+                #logger.info('Reading file: %s', p_entry)
+                # opencv decodes directly to BGR
+                image = cv2.imread(str(p_entry), cv2.IMREAD_COLOR)
+
+                if isinstance(image, type(None)):
+                    # fallback to Pillow for formats opencv cannot read
+                    try:
+                        with Image.open(str(p_entry)) as img:
+                            # alpha, palette, and mono images are converted to 3 channel 8-bit RGB
+                            image = cv2.cvtColor(numpy.asarray(img.convert('RGB')), cv2.COLOR_RGB2BGR)
+                    except PIL.UnidentifiedImageError:
+                        logger.error('Unable to read %s', p_entry)
+                        continue
+
 
-            if night:
-                stg.processImage(p_entry, image)
+                kg.processImage(p_entry, image)
 
 
         kg.finalize(keogram_file, camera)
 
         if night:
-            stg.finalize(startrail_file, camera)
-
             st_frame_count = stg.timelapse_frame_count
             if st_frame_count >= self.config.get('STARTRAILS_TIMELAPSE_MINFRAMES', 250):
+                # frames are only encoded when the timelapse will be generated
+                stg.encodeTimelapseFrames()
+
                 startrail_video_entry = self._miscDb.addStarTrailVideo(
                     startrail_video_file,
                     camera.id,